@@ -1,9 +1,9 @@
 #include <algorithm>
+#include <array>
 #include <cctype>
 #include <concepts>
 #include <cstddef>
 #include <cstdlib>
-#include <deque>
 #include <filesystem>
 #include <fstream>
 #include <functional>
@@ -12,6 +12,8 @@
 #include <optional>
 #include <stdexcept>
 #include <string>
+#include <string_view>
+#include <tuple>
 #include <type_traits>
 #include <unordered_map>
 #include <unordered_set>
@@ -19,6 +21,10 @@
 #include <variant>
 #include <vector>
 
+// everything except main has internal linkage,
+// so the optimizer sees all uses and can inline across the interpreter
+namespace {
+
 // ------------------------------
 // global helper(s)
 // ------------------------------
@@ -46,10 +52,6 @@ struct SourceLocation {
         }
         return "(SourceLocation " + std::to_string(line) + " " + std::to_string(column) + ")";
     }
-    void revert() {
-        line = 1;
-        column = 1;
-    }
     void update(char c) {
         if (c == '\n') {
             line++;
@@ -63,7 +65,7 @@ struct SourceLocation {
     int column;
 };
 
-void panic(
+[[noreturn]] void panic(
     const std::string &type,
     const std::string &msg,
     const SourceLocation &sl = SourceLocation(0, 0)
@@ -75,39 +77,42 @@ void panic(
 // lexer
 // ------------------------------
 
-std::string quote(std::string s) {
+std::string quote(const std::string &s) {
     std::string r;
+    r.reserve(s.size() + 2);
     r += '\"';
-    for (char c : s) {
-        if (c == '\\') {
-            r += "\\\\";
-        } else if (c == '\"') {
-            r += "\\\"";
-        } else {
-            r += c;
+    // copy runs of ordinary characters at once and escape the rest
+    std::size_t start = 0;
+    while (true) {
+        auto special = s.find_first_of("\\\"", start);
+        if (special == std::string::npos) {
+            r.append(s, start);
+            break;
         }
+        r.append(s, start, special - start);
+        r += '\\';
+        r += s[special];
+        start = special + 1;
     }
     r += '\"';
     return r;
 }
 
-std::string unquote(std::string s) {
+std::string unquote(const std::string &s) {
     int n = s.size();
     if (!((n >= 2) &&
           (s[0] == '\"') &&
           (s[n - 1] == '\"'))) {
         panic("unquote", "invalid quoted string");
     }
-    s = s.substr(1, n - 2);
-    std::reverse(s.begin(), s.end());
     std::string r;
-    while (s.size()) {
-        char c = s.back();
-        s.pop_back();
+    // the result is never longer than the content between the quotes
+    r.reserve(n - 2);
+    for (int i = 1; i < n - 1; i++) {
+        char c = s[i];
         if (c == '\\') {
-            if (s.size()) {
-                char c1 = s.back();
-                s.pop_back();
+            if (i + 1 < n - 1) {
+                char c1 = s[++i];
                 if (c1 == '\\') {
                     r += '\\';
                 } else if (c1 == '"') {
@@ -129,40 +134,72 @@ std::string unquote(std::string s) {
     return r;
 }
 
+// built once at compile time instead of on every lexer invocation
+constexpr std::array<bool, 256> charset = [] {
+    std::string_view charstr =
+        "`1234567890-=~!@#$%^&*()_+"
+        "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
+        "[]\\;',./{}|:\"<>? \t\n";
+    std::array<bool, 256> table{};
+    for (unsigned char c : charstr) {
+        table[c] = true;
+    }
+    return table;
+} ();
+
+constexpr std::string_view specialSymbols = "(){}@";
+
 struct SourceStream {
     SourceStream(std::string s): source(std::move(s)) {
-        std::string charstr =
-            "`1234567890-=~!@#$%^&*()_+"
-            "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
-            "[]\\;',./{}|:\"<>? \t\n";
-        std::unordered_set<char> charset(charstr.begin(), charstr.end());
-        for (char c : source) {
-            if (!charset.contains(c)) {
-                panic("lexer", "unsupported character", sl);
+        // one pass with table lookups; locations are only computed on error
+        auto bad = std::find_if(source.begin(), source.end(), [](unsigned char c) {
+            return !charset[c];
+        });
+        if (bad != source.end()) {
+            for (auto p = source.begin(); p != bad; p++) {
+                sl.update(*p);
             }
-            sl.update(c);
+            panic("lexer", "unsupported character", sl);
         }
-        sl.revert();
-        std::reverse(source.begin(), source.end());
     }
 
     bool hasNext() const {
-        return source.size() > 0;
+        return pos < source.size();
     }
     char peekNext() const {
-        return source.back();
+        return source[pos];
     }
     char popNext() {
-        char c = source.back();
-        source.pop_back();
-        sl.update(c);
-        return c;
-    }
-    SourceLocation getNextSourceLocation() const {
+        return source[pos++];
+    }
+    // locations are only needed at token starts, so they are brought up to date lazily
+    SourceLocation getNextSourceLocation() {
+        while (slPos < pos) {
+            auto newline = source.find('\n', slPos);
+            if (newline == std::string::npos || newline >= pos) {
+                sl.column += pos - slPos;
+                slPos = pos;
+            } else {
+                sl.line++;
+                sl.column = 1;
+                slPos = newline + 1;
+            }
+        }
         return sl;
     }
+    std::size_t getNextPosition() const {
+        return pos;
+    }
+    // the consumed characters from start (inclusive) to the cursor (exclusive)
+    std::string getSlice(std::size_t start) const {
+        return source.substr(start, pos - start);
+    }
 
     std::string source;
+    // cursor to the next character
+    std::size_t pos = 0;
+    // sl is the location of source[slPos]
+    std::size_t slPos = 0;
     SourceLocation sl;
 };
 
@@ -173,42 +210,49 @@ struct Token {
     std::string text;
 };
 
-std::deque<Token> lex(std::string source) {
+std::vector<Token> lex(std::string source) {
     SourceStream ss(std::move(source));
 
-    std::function<std::optional<Token>()> nextToken =
-        [&ss, &nextToken]() -> std::optional<Token> {
-        // skip whitespaces
-        while (ss.hasNext() && std::isspace(ss.peekNext())) {
-            ss.popNext();
+    auto nextToken = [&ss]() -> std::optional<Token> {
+        // skip whitespaces and comments
+        while (ss.hasNext()) {
+            if (std::isspace(ss.peekNext())) {
+                ss.popNext();
+            } else if (ss.peekNext() == '#') {
+                while (ss.hasNext() && ss.peekNext() != '\n') {
+                    ss.popNext();
+                }
+            } else {
+                break;
+            }
         }
         if (!ss.hasNext()) {
             return std::nullopt;
         }
         // read the next token
         auto startsl = ss.getNextSourceLocation();
-        std::string text = "";
+        auto start = ss.getNextPosition();
         // integer literal
         if (std::isdigit(ss.peekNext()) || ss.peekNext() == '-' || ss.peekNext() == '+') {
             if (ss.peekNext() == '-' || ss.peekNext() == '+') {
-                text += ss.popNext();
+                ss.popNext();
             }
             bool hasDigit = false;
             while (ss.hasNext() && std::isdigit(ss.peekNext())) {
                 hasDigit = true;
-                text += ss.popNext();
+                ss.popNext();
             }
             if (!hasDigit) {
                 panic("lexer", "incomplete integer literal", startsl);
             }
         // string literal
         } else if (ss.peekNext() == '"') {
-            text += ss.popNext();
+            ss.popNext();
             bool complete = false;
             bool escape = false;
             while (ss.hasNext()) {
                 if ((!escape) && ss.peekNext() == '"') {
-                    text += ss.popNext();
+                    ss.popNext();
                     complete = true;
                     break;
                 } else {
@@ -218,7 +262,6 @@ std::deque<Token> lex(std::string source) {
                     } else {
                         escape = false;
                     }
-                    text += c;
                 }
             }
             if (!complete) {
@@ -233,34 +276,27 @@ std::deque<Token> lex(std::string source) {
                     ss.peekNext() == '_'
                 )
             ) {
-               text += ss.popNext();
+               ss.popNext();
             }
         // intrinsic
         } else if (ss.peekNext() == '.') {
             while (ss.hasNext() && !(std::isspace(ss.peekNext()) || ss.peekNext() == ')')) {
-                text += ss.popNext();
-            }
-        // special symbol
-        } else if (std::string("(){}@").find(ss.peekNext()) != std::string::npos) {
-            text += ss.popNext();
-        // comment
-        } else if (ss.peekNext() == '#') {
-            while (ss.hasNext() && ss.peekNext() != '\n') {
                 ss.popNext();
             }
-            // nextToken() will consume the \n and recursively continue
-            return nextToken();
+        // special symbol
+        } else if (specialSymbols.find(ss.peekNext()) != std::string_view::npos) {
+            ss.popNext();
         } else {
             panic("lexer", "unsupported starting character", startsl);
         }
-        return Token(startsl, std::move(text));
+        return Token(startsl, ss.getSlice(start));
     };
 
-    std::deque<Token> tokens;
+    std::vector<Token> tokens;
     while (true) {
         auto ret = nextToken();
         if (ret.has_value()) {
-            tokens.push_back(ret.value());
+            tokens.push_back(std::move(ret.value()));
         } else {
             break;
         }
@@ -277,37 +313,168 @@ enum class TraversalMode {
     bottomUp
 };
 
+// runtime type tag so the interpreter can dispatch with a switch instead of dynamic_cast
+enum class NodeType {
+    integerNode,
+    stringNode,
+    variableNode,
+    lambdaNode,
+    letrecNode,
+    ifNode,
+    sequenceNode,
+    intrinsicCallNode,
+    exprCallNode,
+    atNode
+};
+
+// intrinsics are resolved by name once, when the AST is built
+enum class Intrinsic {
+    unknown,
+    makeVoid,
+    add,
+    sub,
+    mul,
+    div,
+    mod,
+    lt,
+    le,
+    gt,
+    ge,
+    eq,
+    ne,
+    logicalAnd,
+    logicalOr,
+    logicalNot,
+    strConcat,
+    strLt,
+    strLe,
+    strGt,
+    strGe,
+    strEq,
+    strNe,
+    strLength,
+    strSlice,
+    quote,
+    unquote,
+    strToInt,
+    intToStr,
+    type,
+    eval,
+    getChar,
+    getInt,
+    putStr,
+    flush
+};
+
+const std::unordered_map<std::string, Intrinsic> intrinsicTable = {
+    {".void", Intrinsic::makeVoid},
+    {".+", Intrinsic::add},
+    {".-", Intrinsic::sub},
+    {".*", Intrinsic::mul},
+    {"./", Intrinsic::div},
+    {".%", Intrinsic::mod},
+    {".<", Intrinsic::lt},
+    {".<=", Intrinsic::le},
+    {".>", Intrinsic::gt},
+    {".>=", Intrinsic::ge},
+    {".=", Intrinsic::eq},
+    {"./=", Intrinsic::ne},
+    {".and", Intrinsic::logicalAnd},
+    {".or", Intrinsic::logicalOr},
+    {".not", Intrinsic::logicalNot},
+    {".s+", Intrinsic::strConcat},
+    {".s<", Intrinsic::strLt},
+    {".s<=", Intrinsic::strLe},
+    {".s>", Intrinsic::strGt},
+    {".s>=", Intrinsic::strGe},
+    {".s=", Intrinsic::strEq},
+    {".s/=", Intrinsic::strNe},
+    {".s||", Intrinsic::strLength},
+    {".s[]", Intrinsic::strSlice},
+    {".quote", Intrinsic::quote},
+    {".unquote", Intrinsic::unquote},
+    {".s->i", Intrinsic::strToInt},
+    {".i->s", Intrinsic::intToStr},
+    {".type", Intrinsic::type},
+    {".eval", Intrinsic::eval},
+    {".getchar", Intrinsic::getChar},
+    {".getint", Intrinsic::getInt},
+    {".putstr", Intrinsic::putStr},
+    {".flush", Intrinsic::flush}
+};
+
+Intrinsic resolveIntrinsic(const std::string &name) {
+    auto entry = intrinsicTable.find(name);
+    if (entry == intrinsicTable.end()) {
+        return Intrinsic::unknown;
+    }
+    return entry->second;
+}
+
+// interned variable name: equal names share one string,
+// so symbols are compared and hashed by address
+using Symbol = const std::string *;
+
+Symbol intern(const std::string &name) {
+    // nodes of an unordered_set are never moved, so the addresses stay valid
+    static std::unordered_set<std::string> symbols;
+    return &(*(symbols.insert(name).first));
+}
+
 // this also prevents implicitly-declared move constructors and move assignment operators
 #define DELETE_COPY(CLASS)\
     CLASS(const CLASS &) = delete;\
     CLASS &operator=(const CLASS &) = delete
 
 struct ExprNode {
+    // a piece of the printed form: either literal text or a subtree to be printed
+    using Piece = std::variant<std::string_view, const ExprNode*>;
+
     DELETE_COPY(ExprNode);
     virtual ~ExprNode() {}
-    ExprNode(SourceLocation s): sl(s) {}
+    ExprNode(SourceLocation s, NodeType t): sl(s), type(t) {}
 
     virtual ExprNode *clone() const = 0;
     virtual void traverse(
         TraversalMode mode,
         std::function<void(ExprNode*)> &callback  // callback may have states
     ) = 0;
-    virtual std::string toString() const = 0;
+    // iterative, so printing deeply nested ASTs doesn't exhaust the native stack
+    std::string toString() const {
+        std::string ret;
+        std::vector<Piece> pieces{this};
+        while (pieces.size()) {
+            auto piece = pieces.back();
+            pieces.pop_back();
+            if (std::holds_alternative<std::string_view>(piece)) {
+                ret += std::get<std::string_view>(piece);
+            } else {
+                std::get<const ExprNode*>(piece)->unfold(pieces);
+            }
+        }
+        return ret;
+    }
     virtual void computeFreeVars() = 0;
     virtual void computeTail(bool parentTail) = 0;
 
+    // small fields are grouped together to avoid padding
     SourceLocation sl;
-    std::unordered_set<std::string> freeVars;
+    const NodeType type;
     bool tail = false;
+    std::unordered_set<Symbol> freeVars;
+protected:
+    // pushes the pieces of this node's printed form in reverse order
+    virtual void unfold(std::vector<Piece> &pieces) const = 0;
 };
 
 // every value is accessed by reference to its location on the heap 
 using Location = int;
 
-struct IntegerNode : public ExprNode {
+struct IntegerNode final : public ExprNode {
     DELETE_COPY(IntegerNode);
     virtual ~IntegerNode() {}
-    IntegerNode(SourceLocation s, std::string v): ExprNode(s), val(std::move(v)) {}
+    IntegerNode(SourceLocation s, std::string v):
+        ExprNode(s, NodeType::integerNode), val(std::move(v)) {}
 
     // covariant return type
     virtual IntegerNode *clone() const override {
@@ -322,9 +489,6 @@ struct IntegerNode : public ExprNode {
     ) override {
         callback(this);
     }
-    virtual std::string toString() const override {
-        return val;
-    }
     virtual void computeFreeVars() override {
     }
     virtual void computeTail(bool parentTail) override {
@@ -333,12 +497,17 @@ struct IntegerNode : public ExprNode {
 
     std::string val;
     Location loc = -1;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(std::string_view(val));
+    }
 };
 
-struct StringNode : public ExprNode {
+struct StringNode final : public ExprNode {
     DELETE_COPY(StringNode);
     virtual ~StringNode() {}
-    StringNode(SourceLocation s, std::string v): ExprNode(s), val(std::move(v)) {}
+    StringNode(SourceLocation s, std::string v):
+        ExprNode(s, NodeType::stringNode), val(std::move(v)) {}
 
     // covariant return type
     virtual StringNode *clone() const override {
@@ -353,9 +522,6 @@ struct StringNode : public ExprNode {
     ) override {
         callback(this);
     }
-    virtual std::string toString() const override {
-        return val;
-    }
     virtual void computeFreeVars() override {
     }
     virtual void computeTail(bool parentTail) override {
@@ -364,12 +530,17 @@ struct StringNode : public ExprNode {
 
     std::string val;
     Location loc = -1;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(std::string_view(val));
+    }
 };
 
-struct VariableNode : public ExprNode {
+struct VariableNode final : public ExprNode {
     DELETE_COPY(VariableNode);
     virtual ~VariableNode() {}
-    VariableNode(SourceLocation s, std::string n): ExprNode(s), name(std::move(n)) {}
+    VariableNode(SourceLocation s, std::string n):
+        ExprNode(s, NodeType::variableNode), name(std::move(n)), symbol(intern(name)) {}
 
     virtual VariableNode *clone() const override {
         auto vnode = new VariableNode(sl, name);
@@ -383,20 +554,26 @@ struct VariableNode : public ExprNode {
     ) override {
         callback(this);
     }
-    virtual std::string toString() const override {
-        return name;
-    }
     virtual void computeFreeVars() override {
-        freeVars.insert(name);
+        freeVars.insert(symbol);
     }
     virtual void computeTail(bool parentTail) override {
         tail = parentTail;
     }
 
     std::string name;
+    Symbol symbol;
+    // env index found by the last lookup at this node (-1 if none yet);
+    // the sequence of names in the env is the same every time a given node is evaluated,
+    // so a matching name at this index is the binding a full lookup would find
+    mutable int envIndex = -1;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(std::string_view(name));
+    }
 };
 
-struct LambdaNode : public ExprNode {
+struct LambdaNode final : public ExprNode {
     DELETE_COPY(LambdaNode);
     virtual ~LambdaNode() {
         for (auto v : varList) {
@@ -405,7 +582,7 @@ struct LambdaNode : public ExprNode {
         delete expr;
     }
     LambdaNode(SourceLocation s, std::vector<VariableNode*> v, ExprNode *e):
-        ExprNode(s), varList(std::move(v)), expr(e) {}
+        ExprNode(s, NodeType::lambdaNode), varList(std::move(v)), expr(e) {}
 
     virtual LambdaNode *clone() const override {
         std::vector<VariableNode*> newVarList;
@@ -430,24 +607,11 @@ struct LambdaNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        std::string ret = "lambda (";
-        for (auto v : varList) {
-            ret += v->toString();
-            ret += " ";
-        }
-        if (ret.back() == ' ') {
-            ret.pop_back();
-        }
-        ret += ") ";
-        ret += expr->toString();
-        return ret;
-    }
     virtual void computeFreeVars() override {
         expr->computeFreeVars();
         freeVars.insert(expr->freeVars.begin(), expr->freeVars.end());
         for (auto var : varList) {
-            freeVars.erase(var->name);
+            freeVars.erase(var->symbol);
         }
     }
     virtual void computeTail(bool parentTail) override {
@@ -460,6 +624,18 @@ struct LambdaNode : public ExprNode {
 
     std::vector<VariableNode*> varList;
     ExprNode *expr;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(expr);
+        pieces.push_back(") ");
+        for (auto v = varList.rbegin(); v != varList.rend(); v++) {
+            pieces.push_back(*v);
+            if (v + 1 != varList.rend()) {
+                pieces.push_back(" ");
+            }
+        }
+        pieces.push_back("lambda (");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         for (auto var : varList) {
@@ -469,7 +645,7 @@ private:
     }
 };
 
-struct LetrecNode : public ExprNode {
+struct LetrecNode final : public ExprNode {
     DELETE_COPY(LetrecNode);
     virtual ~LetrecNode() {
         for (auto &ve : varExprList) {
@@ -479,7 +655,7 @@ struct LetrecNode : public ExprNode {
         delete expr;
     }
     LetrecNode(SourceLocation s, std::vector<std::pair<VariableNode*, ExprNode*>> v, ExprNode *e):
-        ExprNode(s), varExprList(std::move(v)), expr(e) {}
+        ExprNode(s, NodeType::letrecNode), varExprList(std::move(v)), expr(e) {}
 
     virtual LetrecNode *clone() const override {
         std::vector<std::pair<VariableNode*, ExprNode*>> newVarExprList;
@@ -505,21 +681,6 @@ struct LetrecNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        std::string ret = "letrec (";
-        for (const auto &ve : varExprList) {
-            ret += ve.first->toString();
-            ret += " ";
-            ret += ve.second->toString();
-            ret += " ";
-        }
-        if (ret.back() == ' ') {
-            ret.pop_back();
-        }
-        ret += ") ";
-        ret += expr->toString();
-        return ret;
-    }
     virtual void computeFreeVars() override {
         expr->computeFreeVars();
         freeVars.insert(expr->freeVars.begin(), expr->freeVars.end());
@@ -528,7 +689,7 @@ struct LetrecNode : public ExprNode {
             freeVars.insert(ve.second->freeVars.begin(), ve.second->freeVars.end());
         }
         for (auto &ve : varExprList) {
-            freeVars.erase(ve.first->name);
+            freeVars.erase(ve.first->symbol);
         }
     }
     virtual void computeTail(bool parentTail) override {
@@ -542,6 +703,20 @@ struct LetrecNode : public ExprNode {
     
     std::vector<std::pair<VariableNode*, ExprNode*>> varExprList;
     ExprNode *expr;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(expr);
+        pieces.push_back(") ");
+        for (auto ve = varExprList.rbegin(); ve != varExprList.rend(); ve++) {
+            pieces.push_back(ve->second);
+            pieces.push_back(" ");
+            pieces.push_back(ve->first);
+            if (ve + 1 != varExprList.rend()) {
+                pieces.push_back(" ");
+            }
+        }
+        pieces.push_back("letrec (");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         for (auto &ve : varExprList) {
@@ -552,7 +727,7 @@ private:
     }
 };
 
-struct IfNode : public ExprNode {
+struct IfNode final : public ExprNode {
     DELETE_COPY(IfNode);
     virtual ~IfNode() {
         delete cond;
@@ -560,7 +735,7 @@ struct IfNode : public ExprNode {
         delete branch2;
     }
     IfNode(SourceLocation s, ExprNode *c, ExprNode *b1, ExprNode *b2):
-        ExprNode(s), cond(c), branch1(b1), branch2(b2) {}
+        ExprNode(s, NodeType::ifNode), cond(c), branch1(b1), branch2(b2) {}
 
     virtual IfNode *clone() const override {
         // the evaluation order of the three clones are irrelevant
@@ -581,9 +756,6 @@ struct IfNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        return "if " + cond->toString() + " " + branch1->toString() + " " + branch2->toString();
-    }
     virtual void computeFreeVars() override {
         cond->computeFreeVars();
         freeVars.insert(cond->freeVars.begin(), cond->freeVars.end());
@@ -602,6 +774,15 @@ struct IfNode : public ExprNode {
     ExprNode *cond;
     ExprNode *branch1;
     ExprNode *branch2;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(branch2);
+        pieces.push_back(" ");
+        pieces.push_back(branch1);
+        pieces.push_back(" ");
+        pieces.push_back(cond);
+        pieces.push_back("if ");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         cond->traverse(mode, callback);
@@ -610,7 +791,7 @@ private:
     }
 };
 
-struct SequenceNode : public ExprNode {
+struct SequenceNode final : public ExprNode {
     DELETE_COPY(SequenceNode);
     virtual ~SequenceNode() {
         for (auto e : exprList) {
@@ -618,7 +799,7 @@ struct SequenceNode : public ExprNode {
         }
     }
     SequenceNode(SourceLocation s, std::vector<ExprNode*> e):
-        ExprNode(s), exprList(std::move(e)) {}
+        ExprNode(s, NodeType::sequenceNode), exprList(std::move(e)) {}
 
     virtual SequenceNode *clone() const override {
         std::vector<ExprNode*> newExprList;
@@ -642,18 +823,6 @@ struct SequenceNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        std::string ret = "{";
-        for (auto e : exprList) {
-            ret += e->toString();
-            ret += " ";
-        }
-        if (ret.back() == ' ') {
-            ret.pop_back();
-        }
-        ret += "}";
-        return ret;
-    }
     virtual void computeFreeVars() override {
         for (auto e : exprList) {
             e->computeFreeVars();
@@ -670,6 +839,17 @@ struct SequenceNode : public ExprNode {
     }
 
     std::vector<ExprNode*> exprList;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back("}");
+        for (auto e = exprList.rbegin(); e != exprList.rend(); e++) {
+            pieces.push_back(*e);
+            if (e + 1 != exprList.rend()) {
+                pieces.push_back(" ");
+            }
+        }
+        pieces.push_back("{");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         for (auto e : exprList) {
@@ -678,7 +858,7 @@ private:
     }
 };
 
-struct IntrinsicCallNode : public ExprNode {
+struct IntrinsicCallNode final : public ExprNode {
     DELETE_COPY(IntrinsicCallNode);
     virtual ~IntrinsicCallNode() {
         for (auto a : argList) {
@@ -686,7 +866,10 @@ struct IntrinsicCallNode : public ExprNode {
         }
     }
     IntrinsicCallNode(SourceLocation s, std::string i, std::vector<ExprNode*> a):
-        ExprNode(s), intrinsic(std::move(i)), argList(std::move(a)) {}
+        ExprNode(s, NodeType::intrinsicCallNode),
+        intrinsic(std::move(i)),
+        argList(std::move(a)),
+        code(resolveIntrinsic(intrinsic)) {}
 
     virtual IntrinsicCallNode *clone() const override {
         std::vector<ExprNode*> newArgList;
@@ -710,15 +893,6 @@ struct IntrinsicCallNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        std::string ret = "(" + intrinsic;
-        for (auto a : argList) {
-            ret += " ";
-            ret += a->toString();
-        }
-        ret += ")";
-        return ret;
-    }
     virtual void computeFreeVars() override {
         for (auto a : argList) {
             a->computeFreeVars();
@@ -734,6 +908,17 @@ struct IntrinsicCallNode : public ExprNode {
 
     std::string intrinsic;
     std::vector<ExprNode*> argList;
+    Intrinsic code;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(")");
+        for (auto a = argList.rbegin(); a != argList.rend(); a++) {
+            pieces.push_back(*a);
+            pieces.push_back(" ");
+        }
+        pieces.push_back(std::string_view(intrinsic));
+        pieces.push_back("(");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         for (auto a : argList) {
@@ -742,7 +927,7 @@ private:
     }
 };
 
-struct ExprCallNode : public ExprNode {
+struct ExprCallNode final : public ExprNode {
     DELETE_COPY(ExprCallNode);
     virtual ~ExprCallNode() {
         delete expr;
@@ -751,7 +936,7 @@ struct ExprCallNode : public ExprNode {
         }
     }
     ExprCallNode(SourceLocation s, ExprNode *e, std::vector<ExprNode*> a):
-        ExprNode(s), expr(e), argList(std::move(a)) {}
+        ExprNode(s, NodeType::exprCallNode), expr(e), argList(std::move(a)) {}
 
     virtual ExprCallNode *clone() const override {
         ExprNode *newExpr = expr->clone();
@@ -776,15 +961,6 @@ struct ExprCallNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        std::string ret = "(" + expr->toString();
-        for (auto a : argList) {
-            ret += " ";
-            ret += a->toString();
-        }
-        ret += ")";
-        return ret;
-    }
     virtual void computeFreeVars() override {
         expr->computeFreeVars();
         freeVars.insert(expr->freeVars.begin(), expr->freeVars.end());
@@ -803,6 +979,16 @@ struct ExprCallNode : public ExprNode {
 
     ExprNode *expr;
     std::vector<ExprNode*> argList;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(")");
+        for (auto a = argList.rbegin(); a != argList.rend(); a++) {
+            pieces.push_back(*a);
+            pieces.push_back(" ");
+        }
+        pieces.push_back(expr);
+        pieces.push_back("(");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         expr->traverse(mode, callback);
@@ -812,13 +998,14 @@ private:
     }
 };
 
-struct AtNode : public ExprNode {
+struct AtNode final : public ExprNode {
     DELETE_COPY(AtNode);
     virtual ~AtNode() {
         delete var;
         delete expr;
     }
-    AtNode(SourceLocation s, VariableNode *v, ExprNode *e): ExprNode(s), var(v), expr(e) {}
+    AtNode(SourceLocation s, VariableNode *v, ExprNode *e):
+        ExprNode(s, NodeType::atNode), var(v), expr(e) {}
 
     virtual AtNode *clone() const override {
         // the evaluation order of the two clones are irrelevant
@@ -839,9 +1026,6 @@ struct AtNode : public ExprNode {
             callback(this);
         }
     }
-    virtual std::string toString() const override {
-        return "@ " + var->toString() + " " + expr->toString();
-    }
     virtual void computeFreeVars() override {
         expr->computeFreeVars();
         freeVars.insert(expr->freeVars.begin(), expr->freeVars.end());
@@ -854,6 +1038,13 @@ struct AtNode : public ExprNode {
 
     VariableNode *var;
     ExprNode *expr;
+protected:
+    virtual void unfold(std::vector<Piece> &pieces) const override {
+        pieces.push_back(expr);
+        pieces.push_back(" ");
+        pieces.push_back(var);
+        pieces.push_back("@ ");
+    }
 private:
     void _traverseSubtree(TraversalMode mode, std::function<void(ExprNode*)> &callback) {
         var->traverse(mode, callback);
@@ -863,7 +1054,12 @@ private:
 
 #undef DELETE_COPY
 
-ExprNode *parse(std::deque<Token> tokens) {
+ExprNode *parse(std::vector<Token> tokens) {
+    // tokens before the cursor have been consumed
+    std::size_t cur = 0;
+    auto remaining = [&tokens, &cur]() -> std::size_t {
+        return tokens.size() - cur;
+    };
     auto isIntegerToken = [](const Token &token) {
         return token.text.size() > 0 && (
             std::isdigit(token.text[0]) ||
@@ -880,17 +1076,18 @@ ExprNode *parse(std::deque<Token> tokens) {
     auto isVariableToken = [](const Token &token) {
         return token.text.size() > 0 && (std::isalpha(token.text[0]) || token.text[0] == '_');
     };
-    auto isTheToken = [](const std::string &s) {
+    auto isTheToken = [](std::string_view s) {
         return [s](const Token &token) {
             return token.text == s;
         };
     };
-    auto consume = [&tokens]<typename Callable>(const Callable &predicate) -> Token {
-        if (tokens.size() == 0) {
+    auto consume =
+        [&tokens, &cur, &remaining]<typename Callable>(const Callable &predicate) -> Token {
+        if (remaining() == 0) {
             panic("parser", "incomplete token stream");
         }
-        auto token = tokens.front();
-        tokens.pop_front();
+        // each token is consumed exactly once, so its text can be moved out
+        auto token = std::move(tokens[cur++]);
         if (!predicate(token)) {
             panic("parser", "unexpected token", token.sl);
         }
@@ -911,11 +1108,11 @@ ExprNode *parse(std::deque<Token> tokens) {
 
     parseInteger = [&]() -> IntegerNode* {
         auto token = consume(isIntegerToken);
-        return new IntegerNode(token.sl, token.text);
+        return new IntegerNode(token.sl, std::move(token.text));
     };
     parseString = [&]() -> StringNode* {  // don't unquote here: AST keeps raw tokens
         auto token = consume(isStringToken);
-        return new StringNode(token.sl, token.text);
+        return new StringNode(token.sl, std::move(token.text));
     };
     parseVariable = [&]() -> VariableNode* {
         auto token = consume(isVariableToken);
@@ -925,7 +1122,7 @@ ExprNode *parse(std::deque<Token> tokens) {
         auto start = consume(isTheToken("lambda"));
         consume(isTheToken("("));
         std::vector<VariableNode*> varList;
-        while (tokens.size() && isVariableToken(tokens[0])) {
+        while (remaining() && isVariableToken(tokens[cur])) {
             varList.push_back(parseVariable());
         }
         consume(isTheToken(")"));
@@ -936,7 +1133,7 @@ ExprNode *parse(std::deque<Token> tokens) {
         auto start = consume(isTheToken("letrec"));
         consume(isTheToken("("));
         std::vector<std::pair<VariableNode*, ExprNode*>> varExprList;
-        while (tokens.size() && isVariableToken(tokens[0])) {
+        while (remaining() && isVariableToken(tokens[cur])) {
             // enforce the evaluation order of v; e
             auto v = parseVariable();
             auto e = parseExpr();
@@ -956,7 +1153,7 @@ ExprNode *parse(std::deque<Token> tokens) {
     parseSequence = [&]() -> SequenceNode* {
         auto start = consume(isTheToken("{"));
         std::vector<ExprNode*> exprList;
-        while (tokens.size() && tokens[0].text != "}") {
+        while (remaining() && tokens[cur].text != "}") {
             exprList.push_back(parseExpr());
         }
         if (!exprList.size()) {
@@ -969,7 +1166,7 @@ ExprNode *parse(std::deque<Token> tokens) {
         auto start = consume(isTheToken("("));
         auto intrinsic = consume(isIntrinsicToken);
         std::vector<ExprNode*> argList;
-        while (tokens.size() && tokens[0].text != ")") {
+        while (remaining() && tokens[cur].text != ")") {
             argList.push_back(parseExpr());
         }
         consume(isTheToken(")"));
@@ -979,7 +1176,7 @@ ExprNode *parse(std::deque<Token> tokens) {
         auto start = consume(isTheToken("("));
         auto expr = parseExpr();
         std::vector<ExprNode*> argList;
-        while (tokens.size() && tokens[0].text != ")") {
+        while (remaining() && tokens[cur].text != ")") {
             argList.push_back(parseExpr());
         }
         consume(isTheToken(")"));
@@ -991,46 +1188,50 @@ ExprNode *parse(std::deque<Token> tokens) {
         auto expr = parseExpr();
         return new AtNode(start.sl, var, expr);
     };
+    // keywords have the form of variables, so only variable-like tokens are looked up
+    const std::unordered_map<std::string_view, std::function<ExprNode*()>> keywordParsers = {
+        {"lambda", [&]() -> ExprNode* { return parseLambda(); }},
+        {"letrec", [&]() -> ExprNode* { return parseLetrec(); }},
+        {"if", [&]() -> ExprNode* { return parseIf(); }}
+    };
     parseExpr = [&]() -> ExprNode* {
-        if (!tokens.size()) {
+        if (!remaining()) {
             panic("parser", "incomplete token stream");
             return nullptr;
-        } else if (isIntegerToken(tokens[0])) {
+        } else if (isIntegerToken(tokens[cur])) {
             return parseInteger();
-        } else if (isStringToken(tokens[0])) {
+        } else if (isStringToken(tokens[cur])) {
             return parseString();
-        } else if (tokens[0].text == "lambda") {
-            return parseLambda();
-        } else if (tokens[0].text == "letrec") {
-            return parseLetrec();
-        } else if (tokens[0].text == "if") {
-            return parseIf();
-        // check keywords before var to avoid recognizing keywords as vars
-        } else if (isVariableToken(tokens[0])) {
+        } else if (isVariableToken(tokens[cur])) {
+            // check keywords before var to avoid recognizing keywords as vars
+            auto keyword = keywordParsers.find(tokens[cur].text);
+            if (keyword != keywordParsers.end()) {
+                return keyword->second();
+            }
             return parseVariable();
-        } else if (tokens[0].text == "{") {
+        } else if (tokens[cur].text == "{") {
             return parseSequence();
-        } else if (tokens[0].text == "(") {
-            if (tokens.size() < 2) {
+        } else if (tokens[cur].text == "(") {
+            if (remaining() < 2) {
                 panic("parser", "incomplete token stream");
                 return nullptr;
             }
-            if (isIntrinsicToken(tokens[1])) {
+            if (isIntrinsicToken(tokens[cur + 1])) {
                 return parseIntrinsicCall();
             } else {
                 return parseExprCall();
             }
-        } else if (tokens[0].text == "@") {
+        } else if (tokens[cur].text == "@") {
             return parseAt();
         } else {
-            panic("parser", "unrecognized token", tokens[0].sl);
+            panic("parser", "unrecognized token", tokens[cur].sl);
             return nullptr;
         }
     };
 
     auto expr = parseExpr();
-    if (tokens.size()) {
-        panic("parser", "redundant token(s)", tokens[0].sl);
+    if (remaining()) {
+        panic("parser", "redundant token(s)", tokens[cur].sl);
     }
     return expr;
 }
@@ -1068,9 +1269,9 @@ struct String {  // for string literals, this class contains the unquoted ones
 };
 
 // variable environment; newer variables have larger indices
-using Env = std::vector<std::pair<std::string, Location>>;
+using Env = std::vector<std::pair<Symbol, Location>>;
 
-std::optional<Location> lookup(const std::string &name, const Env &env) {
+std::optional<Location> lookup(Symbol name, const Env &env) {
     for (auto p = env.rbegin(); p != env.rend(); p++) {
         if (p->first == name) {
             return p->second;
@@ -1094,15 +1295,7 @@ struct Closure {
 using Value = std::variant<Void, Integer, String, Closure>;
 
 std::string valueToString(const Value &v) {
-    if (std::holds_alternative<Void>(v)) {
-        return std::get<Void>(v).toString();
-    } else if (std::holds_alternative<Integer>(v)) {
-        return std::get<Integer>(v).toString();
-    } else if (std::holds_alternative<String>(v)) {
-        return std::get<String>(v).toString();
-    } else {
-        return std::get<Closure>(v).toString();
-    }
+    return std::visit([](const auto &alt) { return alt.toString(); }, v);
 }
 
 // stack layer
@@ -1124,13 +1317,61 @@ struct Layer {
     std::vector<Location> local;
 };
 
+// the evaluation stack (with the std::vector interface used by State);
+// popped layers stay allocated and are reinitialized by later pushes,
+// so their "local" buffers keep the capacity they have grown to
+class LayerStack {
+public:
+    void reserve(std::size_t n) {
+        layers.reserve(n);
+    }
+    Layer &back() {
+        return layers[top - 1];
+    }
+    void emplace_back(std::shared_ptr<Env> env, const ExprNode *expr, bool frame = false) {
+        if (top == layers.size()) {
+            layers.emplace_back(std::move(env), expr, frame);
+        } else {
+            auto &layer = layers[top];
+            layer.env = std::move(env);
+            layer.expr = expr;
+            layer.frame = frame;
+            layer.pc = 0;
+            layer.local.clear();
+        }
+        top++;
+    }
+    void pop_back() {
+        top--;
+        // don't keep the env alive from an unused layer
+        layers[top].env.reset();
+    }
+    std::vector<Layer>::iterator begin() {
+        return layers.begin();
+    }
+    std::vector<Layer>::iterator end() {
+        return layers.begin() + top;
+    }
+    std::vector<Layer>::const_iterator begin() const {
+        return layers.begin();
+    }
+    std::vector<Layer>::const_iterator end() const {
+        return layers.begin() + top;
+    }
+private:
+    std::vector<Layer> layers;
+    // number of layers in use
+    std::size_t top = 0;
+};
+
 class State {
 public:
     State(std::string source) {
         // parsing and static analysis (TODO: exceptions?)
         expr = parse(lex(std::move(source)));
         std::function<void(ExprNode*)> checkDuplicate = [](ExprNode *e) -> void {
-            if (auto lnode = dynamic_cast<LambdaNode*>(e)) {
+            if (e->type == NodeType::lambdaNode) {
+                auto lnode = static_cast<LambdaNode*>(e);
                 std::unordered_set<std::string> varNames;
                 for (auto var : lnode->varList) {
                     if (varNames.contains(var->name)) {
@@ -1138,7 +1379,8 @@ public:
                     }
                     varNames.insert(var->name);
                 }
-            } else if (auto lnode = dynamic_cast<LetrecNode*>(e)) {
+            } else if (e->type == NodeType::letrecNode) {
+                auto lnode = static_cast<LetrecNode*>(e);
                 std::unordered_set<std::string> varNames;
                 for (const auto &ve : lnode->varExprList) {
                     if (varNames.contains(ve.first->name)) {
@@ -1151,16 +1393,39 @@ public:
         expr->traverse(TraversalMode::topDown, checkDuplicate);
         expr->computeFreeVars();
         expr->computeTail(false);
+        // pre-allocate the shared void object and small integers,
+        // which are reused by intrinsic results (see _internedOrNew)
+        voidLoc = _new<Void>();
+        smallIntegerBase = heap.size();
+        std::unordered_map<int, Location> integerLocs;
+        for (int v = smallIntegerMin; v <= smallIntegerMax; v++) {
+            integerLocs[v] = _new<Integer>(v);
+        }
         // pre-allocate integer literals and string literals
-        std::function<void(ExprNode*)> preAllocate = [this](ExprNode *e) -> void {
-            if (auto inode = dynamic_cast<IntegerNode*>(e)) {
-                inode->loc = this->_new<Integer>(std::stoi(inode->val));  // TODO: exceptions
-            } else if (auto snode = dynamic_cast<StringNode*>(e)) {
-                snode->loc = this->_new<String>(unquote(snode->val));
+        // (objects are immutable, so equal literals can share one location)
+        std::unordered_map<std::string, Location> stringLocs;
+        std::function<void(ExprNode*)> preAllocate =
+            [this, &integerLocs, &stringLocs](ExprNode *e) -> void {
+            if (e->type == NodeType::integerNode) {
+                auto inode = static_cast<IntegerNode*>(e);
+                int v = std::stoi(inode->val);  // TODO: exceptions
+                if (!integerLocs.contains(v)) {
+                    integerLocs[v] = this->_new<Integer>(v);
+                }
+                inode->loc = integerLocs[v];
+            } else if (e->type == NodeType::stringNode) {
+                auto snode = static_cast<StringNode*>(e);
+                auto v = unquote(snode->val);
+                if (!stringLocs.contains(v)) {
+                    stringLocs[v] = this->_new<String>(v);
+                }
+                snode->loc = stringLocs[v];
             }
         };
         expr->traverse(TraversalMode::topDown, preAllocate);
         numLiterals = heap.size();
+        // typical programs stay within this depth, so the stack rarely needs to reallocate
+        stack.reserve(initialStackCapacity);
         // the main frame (which cannot be removed by TCO)
         stack.emplace_back(std::make_shared<Env>(), nullptr, true);
         // the first expression (using the env of the main frame)
@@ -1171,6 +1436,8 @@ public:
         stack(state.stack),
         heap(state.heap),
         numLiterals(state.numLiterals),
+        voidLoc(state.voidLoc),
+        smallIntegerBase(state.smallIntegerBase),
         resultLoc(state.resultLoc) {
     }
     State &operator=(const State &state) {
@@ -1180,6 +1447,8 @@ public:
             stack = state.stack;
             heap = state.heap;
             numLiterals = state.numLiterals;
+            voidLoc = state.voidLoc;
+            smallIntegerBase = state.smallIntegerBase;
             resultLoc = state.resultLoc;
         }
         return *this;
@@ -1189,6 +1458,8 @@ public:
         stack(std::move(state.stack)),
         heap(std::move(state.heap)),
         numLiterals(state.numLiterals),
+        voidLoc(state.voidLoc),
+        smallIntegerBase(state.smallIntegerBase),
         resultLoc(state.resultLoc) {
         state.expr = nullptr;
     }
@@ -1200,6 +1471,8 @@ public:
             stack = std::move(state.stack);
             heap = std::move(state.heap);
             numLiterals = state.numLiterals;
+            voidLoc = state.voidLoc;
+            smallIntegerBase = state.smallIntegerBase;
             resultLoc = state.resultLoc;
         }
         return *this;
@@ -1220,253 +1493,50 @@ public:
             return false;
         }
         // evaluations for every case
-        if (auto inode = dynamic_cast<const IntegerNode*>(layer.expr)) {
-            resultLoc = inode->loc;
-            stack.pop_back();
-        } else if (auto snode = dynamic_cast<const StringNode*>(layer.expr)) {
-            resultLoc = snode->loc;
-            stack.pop_back();
-        } else if (auto vnode = dynamic_cast<const VariableNode*>(layer.expr)) {
-            auto varName = vnode->name;
-            auto loc = lookup(varName, *(layer.env));
-            if (!loc.has_value()) {
+        switch (layer.expr->type) {
+            case NodeType::integerNode:
+                _stepInteger(static_cast<const IntegerNode*>(layer.expr));
+                break;
+            case NodeType::stringNode:
+                _stepString(static_cast<const StringNode*>(layer.expr));
+                break;
+            case NodeType::variableNode:
+                _stepVariable(layer, static_cast<const VariableNode*>(layer.expr));
+                break;
+            case NodeType::lambdaNode:
+                _stepLambda(layer, static_cast<const LambdaNode*>(layer.expr));
+                break;
+            case NodeType::letrecNode:
+                _stepLetrec(layer, static_cast<const LetrecNode*>(layer.expr));
+                break;
+            case NodeType::ifNode:
+                _stepIf(layer, static_cast<const IfNode*>(layer.expr));
+                break;
+            case NodeType::sequenceNode:
+                _stepSequence(layer, static_cast<const SequenceNode*>(layer.expr));
+                break;
+            case NodeType::intrinsicCallNode:
+                _stepIntrinsicCall(layer, static_cast<const IntrinsicCallNode*>(layer.expr));
+                break;
+            case NodeType::exprCallNode:
+                _stepExprCall(layer, static_cast<const ExprCallNode*>(layer.expr));
+                break;
+            case NodeType::atNode:
+                _stepAt(layer, static_cast<const AtNode*>(layer.expr));
+                break;
+            default: {
                 _errorStack();
-                panic("runtime", "undefined variable " + varName, layer.expr->sl);
-            }
-            resultLoc = loc.value();
-            stack.pop_back();
-        } else if (auto lnode = dynamic_cast<const LambdaNode*>(layer.expr)) {
-            // copy the statically used part of the env into the closure
-            Env savedEnv;
-            // copy
-            auto usedVars = lnode->freeVars;
-            for (auto ptr = layer.env->rbegin(); ptr != layer.env->rend(); ptr++) {
-                if (usedVars.empty()) {
-                    break;
-                }
-                if (usedVars.contains(ptr->first)) {
-                    savedEnv.push_back(*ptr);
-                    usedVars.erase(ptr->first);
-                }
+                panic("runtime", "unrecognized AST node", layer.expr->sl);
             }
-            std::reverse(savedEnv.begin(), savedEnv.end());
-            resultLoc = _new<Closure>(savedEnv, lnode);
-            stack.pop_back();
-        } else if (auto lnode = dynamic_cast<const LetrecNode*>(layer.expr)) {
-            // unified argument recording
-            if (layer.pc > 1 && layer.pc <= static_cast<int>(lnode->varExprList.size()) + 1) {
-                auto varName = lnode->varExprList[layer.pc - 2].first->name;
-                auto loc = lookup(
-                    varName,
-                    *(layer.env)
-                );
-                // this shouldn't happen since those variables are newly introduced by letrec
-                if (!loc.has_value()) {
-                    _errorStack();
-                    panic("runtime", "undefined variable " + varName, layer.expr->sl);
-                }
-                // copy (inherited resultLoc)
-                heap[loc.value()] = heap[resultLoc];
-            }
-            // create all new locations
-            if (layer.pc == 0) {
-                layer.pc++;
-                for (const auto &[var, _] : lnode->varExprList) {
-                    layer.env->push_back(std::make_pair(
-                        var->name,
-                        _new<Void>()
-                    ));
-                }
-            // evaluate bindings
-            } else if (layer.pc <= static_cast<int>(lnode->varExprList.size())) {
-                layer.pc++;
-                // note: growing the stack might invalidate the reference "layer"
-                //       but this is fine since next time "layer" will be re-bound
-                stack.emplace_back(
-                    layer.env,
-                    lnode->varExprList[layer.pc - 2].second
-                );
-            // evaluate body
-            } else if (layer.pc == static_cast<int>(lnode->varExprList.size()) + 1) {
-                layer.pc++;
-                stack.emplace_back(
-                    layer.env,
-                    lnode->expr
-                );
-            // finish letrec
-            } else {
-                int nParams = lnode->varExprList.size();
-                for (int i = 0; i < nParams; i++) {
-                    layer.env->pop_back();
-                }
-                // this layer cannot be optimized by TCO because we need nParams to revert env
-                // no need to update resultLoc: inherited from body evaluation
-                stack.pop_back();
-            }
-        } else if (auto inode = dynamic_cast<const IfNode*>(layer.expr)) {
-            // evaluate condition
-            if (layer.pc == 0) {
-                layer.pc++;
-                stack.emplace_back(layer.env, inode->cond);
-            // evaluate one branch
-            } else if (layer.pc == 1) {
-                layer.pc++;
-                // inherited condition value
-                if (!std::holds_alternative<Integer>(heap[resultLoc])) {
-                    _errorStack();
-                    panic("runtime", "wrong cond type", layer.expr->sl);
-                }
-                if (std::get<Integer>(heap[resultLoc]).value) {
-                    stack.emplace_back(layer.env, inode->branch1);
-                } else {
-                    stack.emplace_back(layer.env, inode->branch2);
-                }
-            // finish if
-            } else {
-                // no need to update resultLoc: inherited
-                stack.pop_back();
-            }
-        } else if (auto snode = dynamic_cast<const SequenceNode*>(layer.expr)) {
-            // evaluate one-by-one
-            if (layer.pc < static_cast<int>(snode->exprList.size())) {
-                layer.pc++;
-                stack.emplace_back(
-                    layer.env,
-                    snode->exprList[layer.pc - 1]
-                );
-            // finish
-            } else {
-                // sequence's value is the last expression's value
-                // no need to update resultLoc: inherited
-                stack.pop_back();
-            }
-        } else if (auto inode = dynamic_cast<const IntrinsicCallNode*>(layer.expr)) {
-            // unified argument recording
-            if (layer.pc > 0 && layer.pc <= static_cast<int>(inode->argList.size())) {
-                layer.local.push_back(resultLoc);
-            }
-            // evaluate arguments
-            if (layer.pc < static_cast<int>(inode->argList.size())) {
-                layer.pc++;
-                stack.emplace_back(
-                    layer.env,
-                    inode->argList[layer.pc - 1]
-                );
-            // intrinsic call doesn't grow the stack
-            } else {
-                auto value = _callIntrinsic(
-                    layer.expr->sl,
-                    inode->intrinsic,
-                    // intrinsic call is pass by reference
-                    layer.local
-                );
-                resultLoc = _moveNew(std::move(value));
-                stack.pop_back();
-            }
-        } else if (auto enode = dynamic_cast<const ExprCallNode*>(layer.expr)) {
-            // unified argument recording
-            if (layer.pc > 2 && layer.pc <= static_cast<int>(enode->argList.size()) + 2) {
-                layer.local.push_back(resultLoc);
-            }
-            // evaluate the callee
-            if (layer.pc == 0) {
-                layer.pc++;
-                stack.emplace_back(
-                    layer.env,
-                    enode->expr
-                );
-            // initialization
-            } else if (layer.pc == 1) {
-                layer.pc++;
-                // inherited callee location
-                layer.local.push_back(resultLoc);
-            // evaluate arguments
-            } else if (layer.pc <= static_cast<int>(enode->argList.size()) + 1) {
-                layer.pc++;
-                stack.emplace_back(
-                    layer.env,
-                    enode->argList[layer.pc - 3]
-                );
-            // call
-            } else if (layer.pc == static_cast<int>(enode->argList.size()) + 2) {
-                layer.pc++;
-                auto exprLoc = layer.local[0];
-                if (!std::holds_alternative<Closure>(heap[exprLoc])) {
-                    _errorStack();
-                    panic("runtime", "calling a non-callable", layer.expr->sl);
-                }
-                auto &closure = std::get<Closure>(heap[exprLoc]);
-                // types will be checked inside the closure call
-                if (
-                    static_cast<int>(layer.local.size()) - 1 !=
-                    static_cast<int>(closure.fun->varList.size())
-                ) {
-                    _errorStack();
-                    panic("runtime", "wrong number of arguments", layer.expr->sl);
-                }
-                int nArgs = static_cast<int>(closure.fun->varList.size());
-                // lexical scope: copy the env from the closure definition place
-                auto newEnv = closure.env;
-                for (int i = 0; i < nArgs; i++) {
-                    // closure call is pass by reference
-                    newEnv.push_back(std::make_pair(
-                        closure.fun->varList[i]->name,
-                        layer.local[i + 1]
-                    ));
-                }
-                // tail call optimization
-                if (enode->tail) {
-                    while (!(stack.back().frame)) {
-                        stack.pop_back();
-                    }
-                    // pop the frame
-                    stack.pop_back();
-                }
-                // evaluation of the closure body
-                stack.emplace_back(
-                    // new frame has new env
-                    std::make_shared<Env>(std::move(newEnv)),
-                    closure.fun->expr,
-                    true
-                );
-            // finish
-            } else {
-                // no need to update resultLoc: inherited
-                stack.pop_back();
-            }
-        } else if (auto anode = dynamic_cast<const AtNode*>(layer.expr)) {
-            // evaluate the expr
-            if (layer.pc == 0) {
-                layer.pc++;
-                stack.emplace_back(layer.env, anode->expr);
-            } else {
-                // inherited resultLoc
-                if (!std::holds_alternative<Closure>(heap[resultLoc])) {
-                    _errorStack();
-                    panic("runtime", "@ wrong type", layer.expr->sl);
-                }
-                auto varName = anode->var->name;
-                auto loc = lookup(
-                    varName,
-                    std::get<Closure>(heap[resultLoc]).env
-                );
-                if (!loc.has_value()) {
-                    _errorStack();
-                    panic("runtime", "undefined variable " + varName, layer.expr->sl);
-                }
-                // "access by reference"
-                resultLoc = loc.value();
-                stack.pop_back();
-            }
-        } else {
-            _errorStack();
-            panic("runtime", "unrecognized AST node", layer.expr->sl);
         }
         return true;
     }
     void execute() {
         // can choose different initial values here
         int gc_threshold = numLiterals + 64;
+        // the heap is collected once it passes the threshold,
+        // so reserving that much avoids reallocating (and moving every value) in between
+        heap.reserve(gc_threshold + 1);
         while (step()) {
             int total = heap.size();
             if (total > gc_threshold) {
@@ -1475,6 +1545,7 @@ public:
                 // see also "Optimal heap limits for reducing browser memory use" (OOPSLA 2022)
                 // for the square root solution
                 gc_threshold = live * 2;
+                heap.reserve(gc_threshold + 1);
             }
         }
     }
@@ -1482,252 +1553,504 @@ public:
         return heap[resultLoc];
     }
 private:
+    Location _lookupVariable(const VariableNode *vnode, const Env &env) {
+        int n = env.size();
+        int i = vnode->envIndex;
+        if (0 <= i && i < n && env[i].first == vnode->symbol) {
+            return env[i].second;
+        }
+        for (i = n - 1; i >= 0; i--) {
+            if (env[i].first == vnode->symbol) {
+                vnode->envIndex = i;
+                return env[i].second;
+            }
+        }
+        _errorStack();
+        panic("runtime", "undefined variable " + vnode->name, vnode->sl);
+    }
+    // evaluates e for the current layer: leaves are evaluated right away,
+    // other expressions get a new layer on top of the stack;
+    // either way resultLoc holds the value when the current layer is stepped next
+    void _evaluate(Layer &layer, const ExprNode *e) {
+        switch (e->type) {
+            case NodeType::integerNode:
+                resultLoc = static_cast<const IntegerNode*>(e)->loc;
+                break;
+            case NodeType::stringNode:
+                resultLoc = static_cast<const StringNode*>(e)->loc;
+                break;
+            case NodeType::variableNode:
+                resultLoc = _lookupVariable(static_cast<const VariableNode*>(e), *(layer.env));
+                break;
+            default:
+                stack.emplace_back(layer.env, e);
+        }
+    }
+    // per-node evaluation steps dispatched by step();
+    // "layer" is the top of the stack, so stack changes must still come last
+    void _stepInteger(const IntegerNode *inode) {
+        resultLoc = inode->loc;
+        stack.pop_back();
+    }
+    void _stepString(const StringNode *snode) {
+        resultLoc = snode->loc;
+        stack.pop_back();
+    }
+    void _stepVariable(Layer &layer, const VariableNode *vnode) {
+        resultLoc = _lookupVariable(vnode, *(layer.env));
+        stack.pop_back();
+    }
+    void _stepLambda(Layer &layer, const LambdaNode *lnode) {
+        // copy the statically used part of the env into the closure
+        const auto &usedVars = lnode->freeVars;
+        Env savedEnv;
+        savedEnv.reserve(usedVars.size());
+        // names already captured (only the newest binding of each name is visible)
+        std::unordered_set<Symbol> captured;
+        captured.reserve(usedVars.size());
+        for (auto ptr = layer.env->rbegin(); ptr != layer.env->rend(); ptr++) {
+            if (savedEnv.size() == usedVars.size()) {
+                break;
+            }
+            if (usedVars.contains(ptr->first) && captured.insert(ptr->first).second) {
+                savedEnv.push_back(*ptr);
+            }
+        }
+        std::reverse(savedEnv.begin(), savedEnv.end());
+        resultLoc = _new<Closure>(std::move(savedEnv), lnode);
+        stack.pop_back();
+    }
+    void _stepLetrec(Layer &layer, const LetrecNode *lnode) {
+        int nParams = lnode->varExprList.size();
+        // unified argument recording
+        if (layer.pc > 1 && layer.pc <= nParams + 1) {
+            // the letrec variables are the newest nParams entries of the env
+            // (bindings are not in tail position, so nothing pops them before this point)
+            auto loc = (*(layer.env))[layer.env->size() - nParams + (layer.pc - 2)].second;
+            // copy (inherited resultLoc)
+            heap[loc] = heap[resultLoc];
+        }
+        // create all new locations
+        if (layer.pc == 0) {
+            layer.pc++;
+            for (const auto &[var, _] : lnode->varExprList) {
+                layer.env->push_back(std::make_pair(
+                    var->symbol,
+                    _new<Void>()
+                ));
+            }
+        // evaluate bindings
+        } else if (layer.pc <= nParams) {
+            layer.pc++;
+            // note: growing the stack might invalidate the reference "layer"
+            //       but this is fine since next time "layer" will be re-bound
+            _evaluate(layer, lnode->varExprList[layer.pc - 2].second);
+        // evaluate body
+        } else if (layer.pc == nParams + 1) {
+            layer.pc++;
+            _evaluate(layer, lnode->expr);
+        // finish letrec
+        } else {
+            for (int i = 0; i < nParams; i++) {
+                layer.env->pop_back();
+            }
+            // this layer cannot be optimized by TCO because we need nParams to revert env
+            // no need to update resultLoc: inherited from body evaluation
+            stack.pop_back();
+        }
+    }
+    void _stepIf(Layer &layer, const IfNode *inode) {
+        // evaluate condition
+        if (layer.pc == 0) {
+            layer.pc++;
+            _evaluate(layer, inode->cond);
+        // evaluate one branch
+        } else if (layer.pc == 1) {
+            layer.pc++;
+            // inherited condition value
+            if (!std::holds_alternative<Integer>(heap[resultLoc])) {
+                _errorStack();
+                panic("runtime", "wrong cond type", layer.expr->sl);
+            }
+            if (std::get<Integer>(heap[resultLoc]).value) {
+                _evaluate(layer, inode->branch1);
+            } else {
+                _evaluate(layer, inode->branch2);
+            }
+        // finish if
+        } else {
+            // no need to update resultLoc: inherited
+            stack.pop_back();
+        }
+    }
+    void _stepSequence(Layer &layer, const SequenceNode *snode) {
+        int nExprs = snode->exprList.size();
+        // evaluate one-by-one
+        if (layer.pc < nExprs) {
+            layer.pc++;
+            _evaluate(layer, snode->exprList[layer.pc - 1]);
+        // finish
+        } else {
+            // sequence's value is the last expression's value
+            // no need to update resultLoc: inherited
+            stack.pop_back();
+        }
+    }
+    void _stepIntrinsicCall(Layer &layer, const IntrinsicCallNode *inode) {
+        int nArgs = inode->argList.size();
+        // unified argument recording
+        if (layer.pc > 0 && layer.pc <= nArgs) {
+            layer.local.push_back(resultLoc);
+        }
+        if (layer.pc == 0) {
+            layer.local.reserve(nArgs);
+        }
+        // evaluate arguments
+        if (layer.pc < nArgs) {
+            layer.pc++;
+            _evaluate(layer, inode->argList[layer.pc - 1]);
+        // intrinsic call doesn't grow the stack
+        } else {
+            // the most frequent integer intrinsics skip the generic dispatch
+            if (auto v = _fastIntegerIntrinsic(inode->code, layer.local)) {
+                resultLoc = _integerLoc(v.value());
+            } else {
+                Value value;
+                try {
+                    value = _callIntrinsic(
+                        layer.expr->sl,
+                        inode->code,
+                        // intrinsic call is pass by reference
+                        layer.local
+                    );
+                } catch (const std::bad_variant_access &) {
+                    _errorStack();
+                    panic("runtime", "type error on intrinsic call", layer.expr->sl);
+                }
+                resultLoc = _internedOrNew(std::move(value));
+            }
+            stack.pop_back();
+        }
+    }
+    void _stepExprCall(Layer &layer, const ExprCallNode *enode) {
+        int nArgs = enode->argList.size();
+        // unified recording of the callee (pc == 1) and the arguments
+        if (layer.pc > 0 && layer.pc <= nArgs + 1) {
+            layer.local.push_back(resultLoc);
+        }
+        // evaluate the callee
+        if (layer.pc == 0) {
+            layer.pc++;
+            layer.local.reserve(nArgs + 1);
+            _evaluate(layer, enode->expr);
+        // evaluate arguments
+        } else if (layer.pc <= nArgs) {
+            layer.pc++;
+            _evaluate(layer, enode->argList[layer.pc - 2]);
+        // call
+        } else if (layer.pc == nArgs + 1) {
+            layer.pc++;
+            auto exprLoc = layer.local[0];
+            if (!std::holds_alternative<Closure>(heap[exprLoc])) {
+                _errorStack();
+                panic("runtime", "calling a non-callable", layer.expr->sl);
+            }
+            auto &closure = std::get<Closure>(heap[exprLoc]);
+            // types will be checked inside the closure call
+            if (nArgs != static_cast<int>(closure.fun->varList.size())) {
+                _errorStack();
+                panic("runtime", "wrong number of arguments", layer.expr->sl);
+            }
+            // lexical scope: copy the env from the closure definition place
+            // (sized for the parameters too, so the copy is the only allocation)
+            Env newEnv;
+            newEnv.reserve(closure.env.size() + nArgs);
+            newEnv.insert(newEnv.end(), closure.env.begin(), closure.env.end());
+            for (int i = 0; i < nArgs; i++) {
+                // closure call is pass by reference
+                newEnv.push_back(std::make_pair(
+                    closure.fun->varList[i]->symbol,
+                    layer.local[i + 1]
+                ));
+            }
+            // tail call optimization
+            if (enode->tail) {
+                while (!(stack.back().frame)) {
+                    stack.pop_back();
+                }
+                // pop the frame
+                stack.pop_back();
+            }
+            // evaluation of the closure body
+            stack.emplace_back(
+                // new frame has new env
+                std::make_shared<Env>(std::move(newEnv)),
+                closure.fun->expr,
+                true
+            );
+        // finish
+        } else {
+            // no need to update resultLoc: inherited
+            stack.pop_back();
+        }
+    }
+    void _stepAt(Layer &layer, const AtNode *anode) {
+        // evaluate the expr
+        if (layer.pc == 0) {
+            layer.pc++;
+            _evaluate(layer, anode->expr);
+        } else {
+            // inherited resultLoc
+            if (!std::holds_alternative<Closure>(heap[resultLoc])) {
+                _errorStack();
+                panic("runtime", "@ wrong type", layer.expr->sl);
+            }
+            const auto &varName = anode->var->name;
+            auto loc = lookup(
+                anode->var->symbol,
+                std::get<Closure>(heap[resultLoc]).env
+            );
+            if (!loc.has_value()) {
+                _errorStack();
+                panic("runtime", "undefined variable " + varName, layer.expr->sl);
+            }
+            // "access by reference"
+            resultLoc = loc.value();
+            stack.pop_back();
+        }
+    }
+    template <typename Alt>
+    const Alt &_getArg(Location loc) {
+        if constexpr (std::same_as<Alt, Value>) {
+            return heap[loc];
+        } else {
+            return std::get<Alt>(heap[loc]);
+        }
+    }
+    // checks the argument count and reads every argument as the corresponding Alt
+    // (Value accepts any type); all arguments are read before the intrinsic uses any of them,
+    // and a type mismatch throws std::bad_variant_access,
+    // which _stepIntrinsicCall reports as a type error
     template <typename... Alt>
     requires (true && ... && (std::same_as<Alt, Value> || isAlternativeOf<Alt, Value>))
-    void _typecheck(SourceLocation sl, const std::vector<Location> &args) {
-        bool ok = args.size() == sizeof...(Alt);
-        int i = -1;
-        ok = ok && (true && ... && (
-            i++,
-            [&] {
-                if constexpr (std::same_as<Alt, Value>) {
-                    return true;
-                } else {
-                    return std::holds_alternative<Alt>(heap[args[i]]);
-                }
-            } ()
-        ));
-        if (!ok) {
+    std::tuple<const Alt &...> _getArgs(SourceLocation sl, const std::vector<Location> &args) {
+        if (args.size() != sizeof...(Alt)) {
             _errorStack();
             panic("runtime", "type error on intrinsic call", sl);
         }
+        return [&]<std::size_t... I>(std::index_sequence<I...>) {
+            // braced initialization reads the arguments from left to right
+            return std::tuple<const Alt &...>{_getArg<Alt>(args[I])...};
+        } (std::index_sequence_for<Alt...>());
+    }
+    // .+, .-, and .< on two integers; anything else (including ill-typed calls,
+    // which _callIntrinsic reports) returns std::nullopt
+    std::optional<int> _fastIntegerIntrinsic(Intrinsic code, const std::vector<Location> &args) {
+        if (!(code == Intrinsic::add || code == Intrinsic::sub || code == Intrinsic::lt)) {
+            return std::nullopt;
+        }
+        if (args.size() != 2) {
+            return std::nullopt;
+        }
+        auto a = std::get_if<Integer>(&heap[args[0]]);
+        auto b = std::get_if<Integer>(&heap[args[1]]);
+        if (!(a && b)) {
+            return std::nullopt;
+        }
+        if (code == Intrinsic::add) {
+            return a->value + b->value;
+        } else if (code == Intrinsic::sub) {
+            return a->value - b->value;
+        } else {
+            return a->value < b->value ? 1 : 0;
+        }
     }
     // intrinsic dispatch
     Value _callIntrinsic(
-        SourceLocation sl, const std::string &name, const std::vector<Location> &args
+        SourceLocation sl, Intrinsic code, const std::vector<Location> &args
     ) {
-        if (name == ".void") {
-            _typecheck<>(sl, args);
-            return Void();
-        } else if (name == ".+") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value +
-                std::get<Integer>(heap[args[1]]).value
-            );
-        } else if (name == ".-") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value -
-                std::get<Integer>(heap[args[1]]).value
-            );
-        } else if (name == ".*") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value *
-                std::get<Integer>(heap[args[1]]).value
-            );
-        } else if (name == "./") {
-            _typecheck<Integer, Integer>(sl, args);
-            int d = std::get<Integer>(heap[args[1]]).value;
-            if (d == 0) {
-                panic("runtime", "division by zero", sl);
-            }
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value /
-                d
-            );
-        } else if (name == ".%") {
-            _typecheck<Integer, Integer>(sl, args);
-            int d = std::get<Integer>(heap[args[1]]).value;
-            if (d == 0) {
-                panic("runtime", "division by zero", sl);
-            }
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value %
-                d
-            );
-        } else if (name == ".<") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value <
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".<=") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value <=
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".>") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value >
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".>=") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value >=
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".=") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value ==
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == "./=") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value !=
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".and") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value &&
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".or") {
-            _typecheck<Integer, Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value ||
-                std::get<Integer>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".not") {
-            _typecheck<Integer>(sl, args);
-            return Integer(
-                std::get<Integer>(heap[args[0]]).value ? 0 : 1
-            );
-        } else if (name == ".s+") {
-            _typecheck<String, String>(sl, args);
-            return String(
-                std::get<String>(heap[args[0]]).value +
-                std::get<String>(heap[args[1]]).value
-            );
-        } else if (name == ".s<") {
-            _typecheck<String, String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value <
-                std::get<String>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".s<=") {
-            _typecheck<String, String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value <=
-                std::get<String>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".s>") {
-            _typecheck<String, String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value >
-                std::get<String>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".s>=") {
-            _typecheck<String, String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value >=
-                std::get<String>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".s=") {
-            _typecheck<String, String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value ==
-                std::get<String>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".s/=") {
-            _typecheck<String, String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value !=
-                std::get<String>(heap[args[1]]).value ? 1 : 0
-            );
-        } else if (name == ".s||") {
-            _typecheck<String>(sl, args);
-            return Integer(
-                std::get<String>(heap[args[0]]).value.size()
-            );
-        } else if (name == ".s[]") {
-            _typecheck<String, Integer, Integer>(sl, args);
-            int n = std::get<String>(heap[args[0]]).value.size();
-            int l = std::get<Integer>(heap[args[1]]).value;
-            int r = std::get<Integer>(heap[args[2]]).value;
-            if (!(
-                (0 <= l && l < n) &&
-                (0 <= r && r < n) &&
-                (l <= r)
-            )) {
-                panic("runtime", "invalid substring range", sl);
-            }
-            return String(
-                std::get<String>(heap[args[0]]).value.substr(l, r - l)
-            );
-        } else if (name == ".quote") {
-            _typecheck<String>(sl, args);
-            return String(
-                quote(std::get<String>(heap[args[0]]).value)
-            );
-        } else if (name == ".unquote") {
-            _typecheck<String>(sl, args);
-            return String(
-                unquote(std::get<String>(heap[args[0]]).value)
-            );
-        } else if (name == ".s->i") {
-            _typecheck<String>(sl, args);
-            return Integer(
-                std::stoi(std::get<String>(heap[args[0]]).value)  // TODO: exceptions
-            );
-        } else if (name == ".i->s") {
-            _typecheck<Integer>(sl, args);
-            return String(
-                std::to_string(std::get<Integer>(heap[args[0]]).value)
-            );
-        } else if (name == ".type") {
-            _typecheck<Value>(sl, args);
-            int label = -1;
-            if (std::holds_alternative<Void>(heap[args[0]])) {
-                label = 0;
-            } else if (std::holds_alternative<Integer>(heap[args[0]])) {
-                label = 1;
-            } else {
-                label = 2;
-            }
-            return Integer(label);
-        } else if (name == ".eval") {
-            _typecheck<String>(sl, args);
-            State state(std::get<String>(heap[args[0]]).value);
-            state.execute();
-            return state.getResult();  // this should be a copy
-        } else if (name == ".getchar") {
-            _typecheck<>(sl, args);
-            auto c = std::cin.get();
-            if (std::cin.eof()) {
+        switch (code) {
+            case Intrinsic::makeVoid: {
+                _getArgs<>(sl, args);
                 return Void();
-            } else {
-                std::string s;
-                s.push_back(static_cast<char>(c));
-                return String(s);
-            }
-        } else if (name == ".getint") {
-            _typecheck<>(sl, args);
-            int v;
-            if (std::cin >> v) {
-                return Integer(v);
-            } else {
+            }
+            case Intrinsic::add: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value + b.value);
+            }
+            case Intrinsic::sub: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value - b.value);
+            }
+            case Intrinsic::mul: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value * b.value);
+            }
+            case Intrinsic::div: {
+                auto [n, d] = _getArgs<Integer, Integer>(sl, args);
+                if (d.value == 0) {
+                    panic("runtime", "division by zero", sl);
+                }
+                return Integer(n.value / d.value);
+            }
+            case Intrinsic::mod: {
+                auto [n, d] = _getArgs<Integer, Integer>(sl, args);
+                if (d.value == 0) {
+                    panic("runtime", "division by zero", sl);
+                }
+                return Integer(n.value % d.value);
+            }
+            case Intrinsic::lt: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value < b.value ? 1 : 0);
+            }
+            case Intrinsic::le: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value <= b.value ? 1 : 0);
+            }
+            case Intrinsic::gt: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value > b.value ? 1 : 0);
+            }
+            case Intrinsic::ge: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value >= b.value ? 1 : 0);
+            }
+            case Intrinsic::eq: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value == b.value ? 1 : 0);
+            }
+            case Intrinsic::ne: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value != b.value ? 1 : 0);
+            }
+            case Intrinsic::logicalAnd: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value && b.value ? 1 : 0);
+            }
+            case Intrinsic::logicalOr: {
+                auto [a, b] = _getArgs<Integer, Integer>(sl, args);
+                return Integer(a.value || b.value ? 1 : 0);
+            }
+            case Intrinsic::logicalNot: {
+                auto [a] = _getArgs<Integer>(sl, args);
+                return Integer(a.value ? 0 : 1);
+            }
+            case Intrinsic::strConcat: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return String(a.value + b.value);
+            }
+            case Intrinsic::strLt: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return Integer(a.value < b.value ? 1 : 0);
+            }
+            case Intrinsic::strLe: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return Integer(a.value <= b.value ? 1 : 0);
+            }
+            case Intrinsic::strGt: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return Integer(a.value > b.value ? 1 : 0);
+            }
+            case Intrinsic::strGe: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return Integer(a.value >= b.value ? 1 : 0);
+            }
+            case Intrinsic::strEq: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return Integer(a.value == b.value ? 1 : 0);
+            }
+            case Intrinsic::strNe: {
+                auto [a, b] = _getArgs<String, String>(sl, args);
+                return Integer(a.value != b.value ? 1 : 0);
+            }
+            case Intrinsic::strLength: {
+                auto [str] = _getArgs<String>(sl, args);
+                return Integer(str.value.size());
+            }
+            case Intrinsic::strSlice: {
+                auto [str, left, right] = _getArgs<String, Integer, Integer>(sl, args);
+                int n = str.value.size();
+                int l = left.value;
+                int r = right.value;
+                if (!(
+                    (0 <= l && l < n) &&
+                    (0 <= r && r < n) &&
+                    (l <= r)
+                )) {
+                    panic("runtime", "invalid substring range", sl);
+                }
+                return String(str.value.substr(l, r - l));
+            }
+            case Intrinsic::quote: {
+                auto [str] = _getArgs<String>(sl, args);
+                return String(quote(str.value));
+            }
+            case Intrinsic::unquote: {
+                auto [str] = _getArgs<String>(sl, args);
+                return String(unquote(str.value));
+            }
+            case Intrinsic::strToInt: {
+                auto [str] = _getArgs<String>(sl, args);
+                return Integer(std::stoi(str.value));  // TODO: exceptions
+            }
+            case Intrinsic::intToStr: {
+                auto [a] = _getArgs<Integer>(sl, args);
+                return String(std::to_string(a.value));
+            }
+            case Intrinsic::type: {
+                auto [v] = _getArgs<Value>(sl, args);
+                int label = -1;
+                if (std::holds_alternative<Void>(v)) {
+                    label = 0;
+                } else if (std::holds_alternative<Integer>(v)) {
+                    label = 1;
+                } else {
+                    label = 2;
+                }
+                return Integer(label);
+            }
+            case Intrinsic::eval: {
+                auto [str] = _getArgs<String>(sl, args);
+                State state(str.value);
+                state.execute();
+                return state.getResult();  // this should be a copy
+            }
+            case Intrinsic::getChar: {
+                _getArgs<>(sl, args);
+                auto c = std::cin.get();
+                if (std::cin.eof()) {
+                    return Void();
+                } else {
+                    std::string s;
+                    s.push_back(static_cast<char>(c));
+                    return String(s);
+                }
+            }
+            case Intrinsic::getInt: {
+                _getArgs<>(sl, args);
+                int v;
+                if (std::cin >> v) {
+                    return Integer(v);
+                } else {
+                    return Void();
+                }
+            }
+            case Intrinsic::putStr: {
+                auto [str] = _getArgs<String>(sl, args);
+                std::cout.write(str.value.data(), str.value.size());
+                return Void();
+            }
+            case Intrinsic::flush: {
+                _getArgs<>(sl, args);
+                std::cout << std::flush;
+                return Void();
+            }
+            default: {
+                _errorStack();
+                panic("runtime", "unrecognized intrinsic call", sl);
                 return Void();
             }
-        } else if (name == ".putstr") {
-            _typecheck<String>(sl, args);
-            std::cout << std::get<String>(heap[args[0]]).value;
-            return Void();
-        } else if (name == ".flush") {
-            _typecheck<>(sl, args);
-            std::cout << std::flush;
-            return Void();
-        } else {
-            _errorStack();
-            panic("runtime", "unrecognized intrinsic call", sl);
-            return Void();
         }
     }
     // memory management
@@ -1741,19 +2064,30 @@ private:
         heap.push_back(std::move(v));
         return heap.size() - 1;
     }
-    std::unordered_set<Location> _mark() {
-        std::unordered_set<Location> visited;
-        // for each traversed location, specifically handle the closure case
-        std::function<void(Location)> traverseLocation =
-            // "this" captures the current object by reference
-            [this, &visited, &traverseLocation](Location loc) {
-            if (!(visited.contains(loc))) {
-                visited.insert(loc);
-                if (std::holds_alternative<Closure>(heap[loc])) {
-                    for (const auto &[_, l] : std::get<Closure>(heap[loc]).env) {
-                        traverseLocation(l);
-                    }
-                }
+    // only for values nobody writes to (letrec variables need their own locations)
+    Location _internedOrNew(Value v) {
+        if (std::holds_alternative<Void>(v)) {
+            return voidLoc;
+        }
+        if (auto i = std::get_if<Integer>(&v)) {
+            return _integerLoc(i->value);
+        }
+        return _moveNew(std::move(v));
+    }
+    Location _integerLoc(int v) {
+        if (smallIntegerMin <= v && v <= smallIntegerMax) {
+            return smallIntegerBase + (v - smallIntegerMin);
+        }
+        return _new<Integer>(v);
+    }
+    std::vector<bool> _mark() {
+        std::vector<bool> visited(heap.size(), false);
+        // reached but not yet scanned locations
+        std::vector<Location> worklist;
+        auto markLocation = [&visited, &worklist](Location loc) {
+            if (!visited[loc]) {
+                visited[loc] = true;
+                worklist.push_back(loc);
             }
         };
         // traverse the stack
@@ -1761,29 +2095,44 @@ private:
             // only frames "own" the environments
             if (layer.frame) {
                 for (const auto &[_, loc] : (*(layer.env))) {
-                    traverseLocation(loc);
+                    markLocation(loc);
                 }
             }
             // but each layer can still have locals
             for (const auto v : layer.local) {
-                traverseLocation(v);
+                markLocation(v);
+            }
+        }
+        // traverse the resultLoc (if any)
+        if (resultLoc >= 0) {
+            markLocation(resultLoc);
+        }
+        // for each reached location, specifically handle the closure case
+        while (worklist.size()) {
+            auto loc = worklist.back();
+            worklist.pop_back();
+            if (std::holds_alternative<Closure>(heap[loc])) {
+                for (const auto &[_, l] : std::get<Closure>(heap[loc]).env) {
+                    markLocation(l);
+                }
             }
         }
-        // traverse the resultLoc
-        traverseLocation(resultLoc);
         return visited;
     }
-    std::pair<int, std::unordered_map<Location, Location>>
-        _sweepAndCompact(const std::unordered_set<Location> &visited) {
-        std::unordered_map<Location, Location> relocation;
+    std::pair<int, std::vector<Location>> _sweepAndCompact(const std::vector<bool> &visited) {
         Location n = heap.size();
+        // the new location of each live location (literals never move)
+        std::vector<Location> relocation(n);
+        for (Location k = 0; k < numLiterals; k++) {
+            relocation[k] = k;
+        }
         Location i{numLiterals}, j{numLiterals};
         while (j < n) {
-            if (visited.contains(j)) {
+            if (visited[j]) {
                 if (i < j) {
                     heap[i] = std::move(heap[j]);
-                    relocation[j] = i;
                 }
+                relocation[j] = i;
                 i++;
             }
             j++;
@@ -1791,11 +2140,9 @@ private:
         heap.resize(i);
         return std::make_pair(n - i, std::move(relocation));
     }
-    void _relocate(const std::unordered_map<Location, Location> &relocation) {
+    void _relocate(const std::vector<Location> &relocation) {
         auto reloc = [&relocation](Location &loc) -> void {
-            if (relocation.contains(loc)) {
-                loc = relocation.at(loc);
-            }
+            loc = relocation[loc];
         };
         // traverse the stack
         for (auto &layer : stack) {
@@ -1810,8 +2157,10 @@ private:
                 reloc(v);
             }
         }
-        // traverse the resultLoc
-        reloc(resultLoc);
+        // traverse the resultLoc (if any)
+        if (resultLoc >= 0) {
+            reloc(resultLoc);
+        }
         // traverse the closure values
         for (auto &v : heap) {
             if (std::holds_alternative<Closure>(v)) {
@@ -1849,12 +2198,18 @@ private:
         }
     }
 
+    static constexpr std::size_t initialStackCapacity = 1024;
+    static constexpr int smallIntegerMin = -128;
+    static constexpr int smallIntegerMax = 127;
+
     // states
     ExprNode *expr;
-    std::vector<Layer> stack;
+    LayerStack stack;
     std::vector<Value> heap;
     int numLiterals = 0;
-    Location resultLoc;
+    Location voidLoc = -1;
+    Location smallIntegerBase = -1;
+    Location resultLoc = -1;
 };
 
 // ------------------------------
@@ -1877,11 +2232,16 @@ std::string readSource(const std::string &spath) {
     return source;
 }
 
+}  // namespace
+
 int main(int argc, char **argv) {
     if (argc != 2) {
         std::cerr << "Usage: " << argv[0] << " <source-path>\n";
         std::exit(EXIT_FAILURE);
     }
+    // .putstr output is buffered by the C++ stream and flushed by .flush,
+    // by reads from std::cin (tied to std::cout), and at exit
+    std::ios::sync_with_stdio(false);
     try {
         std::string source = readSource(argv[1]);
         State state(std::move(source));